@@ -3,9 +3,9 @@
 # tinygrad implementation of https://github.com/tysam-code/hlb-CIFAR10/blob/main/main.py
 # https://myrtle.ai/learn/how-to-train-your-resnet-8-bag-of-tricks/
 # https://siboehm.com/articles/22/CUDA-MMM
-import random, time
+import random, time, functools, math, threading, queue
 import numpy as np
-from typing import Optional
+from typing import Optional, Tuple
 from extra.datasets import fetch_cifar, cifar_mean, cifar_std
 from extra.lr_scheduler import OneCycleLR
 from tinygrad import nn, dtypes, Tensor, Device, GlobalCounters, TinyJit
@@ -14,6 +14,8 @@ from tinygrad.nn import optim
 from tinygrad.helpers import Context, BEAM, WINO, getenv
 
 BS, STEPS = getenv("BS", 512), getenv("STEPS", 1000)
+# number of micro-batches whose gradients are accumulated per optimizer step
+ACCUM = getenv("ACCUM", 1)
 EVAL_BS = getenv("EVAL_BS", BS)
 GPUS = [f'{Device.DEFAULT}:{i}' for i in range(getenv("GPUS", 1))]
 assert BS % len(GPUS) == 0, f"{BS=} is not a multiple of {len(GPUS)=}, uneven multi GPU is slow"
@@ -27,6 +29,10 @@ else:
   dtypes.default_float = dtypes.float32
   np_dtype = np.float32
 
+# channel statistics scaled to raw 0-255 pixels, built once so normalizing is a single pointwise pass
+CIFAR_MEAN = Tensor(np.array(cifar_mean, dtype=np.float32).reshape((1,3,1,1))*255, device=Device.DEFAULT, requires_grad=False)
+CIFAR_STD = Tensor(np.array(cifar_std, dtype=np.float32).reshape((1,3,1,1))*255, device=Device.DEFAULT, requires_grad=False)
+
 class BatchNorm(nn.BatchNorm2d):
   def __init__(self, num_features):
     super().__init__(num_features, track_running_stats=False, eps=1e-12, momentum=0.85, affine=True)
@@ -41,19 +47,16 @@ class ConvGroup:
     self.norm1 = BatchNorm(channels_out)
     self.norm2 = BatchNorm(channels_out)
 
+  # norm in float32, then cast and gelu. it's one expression after the norm's reduces, so the scheduler fuses it into a single kernel
+  @staticmethod
+  def norm_gelu(x:Tensor, norm:BatchNorm) -> Tensor: return norm(x.float()).cast(dtypes.default_float).quick_gelu()
+
   def __call__(self, x):
     x = self.conv1(x)
     x = x.max_pool2d(2)
-    x = x.float()
-    x = self.norm1(x)
-    x = x.cast(dtypes.default_float)
-    x = x.quick_gelu()
-    residual = x
+    x = residual = self.norm_gelu(x, self.norm1)
     x = self.conv2(x)
-    x = x.float()
-    x = self.norm2(x)
-    x = x.cast(dtypes.default_float)
-    x = x.quick_gelu()
+    x = self.norm_gelu(x, self.norm2)
 
     return x + residual
 
@@ -66,7 +69,8 @@ class SpeedyResNet:
       ConvGroup(32, 64),
       ConvGroup(64, 256),
       ConvGroup(256, 512),
-      lambda x: x.max((2,3)),
+      # logits and everything reduced from them (softmax, loss) stay in float32, like the norms in ConvGroup
+      lambda x: x.max((2,3)).float(),
       nn.Linear(512, 10, bias=False),
       lambda x: x / 9.,
     ]
@@ -84,14 +88,16 @@ hyp = {
   'opt': {
     'bias_lr':            1.76 * bias_scaler/512,
     'non_bias_lr':        1.76 / 512,
-    'bias_decay':         1.08 * 6.45e-4 * BS/bias_scaler,
-    'non_bias_decay':     1.08 * 6.45e-4 * BS,
+    'bias_decay':         1.08 * 6.45e-4 * BS*ACCUM/bias_scaler,
+    'non_bias_decay':     1.08 * 6.45e-4 * BS*ACCUM,
     'final_lr_ratio':     0.025,
     'initial_div_factor': 1e6,
     'label_smoothing':    0.20,
     'momentum':           0.85,
     'percent_start':      0.23,
-    'loss_scale_scaler':  1./128   # (range: ~1/512 - 16+, 1/128 w/ FP16)
+    'loss_scale':         2.**16,  # initial dynamic loss scale with HALF=1, like torch's GradScaler. the first few overflowing steps
+                                   # halve it down to the largest scale the float16 grads fit in, so it stays near that ceiling for the run
+    'loss_scale_growth':  2000,    # steps without overflow before the loss scale is doubled
   },
   'net': {
       'kernel_size': 2,             # kernel size for the whitening layer
@@ -116,18 +122,23 @@ def train_cifar():
   # ========== Model ==========
   # NOTE: np.linalg.eigh only supports float32 so the whitening layer weights need to be converted to float16 manually
   def whitening(X, kernel_size=hyp['net']['kernel_size']):
-    def _cov(X):
-      return (X.T @ X) / (X.shape[0] - 1)
-
+    # accumulate X.T @ X a chunk of images at a time so the full (N*H'*W', c*h*w) patch matrix is never materialized
+    def _cov(patches, chunk_size=1024):
+      n,c,oy,ox,h,w = patches.shape
+      Σ = np.zeros((c*h*w, c*h*w), dtype=patches.dtype)
+      for i in range(0, n, chunk_size):
+        X = patches[i:i+chunk_size].transpose((0,2,3,1,4,5)).reshape((-1,c*h*w))
+        Σ += X.T @ X
+      return Σ / (n*oy*ox - 1)
+
+    # (N, C, H', W', h, w) strided view of the input, no copy
     def _patches(data, patch_size=(kernel_size,kernel_size)):
       h, w = patch_size
-      c = data.shape[1]
-      axis = (2, 3)
-      return np.lib.stride_tricks.sliding_window_view(data, window_shape=(h,w), axis=axis).transpose((0,3,2,1,4,5)).reshape((-1,c,h,w))
+      return np.lib.stride_tricks.sliding_window_view(data, window_shape=(h,w), axis=(2,3))
 
     def _eigens(patches):
-      n,c,h,w = patches.shape
-      Σ = _cov(patches.reshape(n, c*h*w))
+      c,h,w = patches.shape[1], *patches.shape[4:]
+      Σ = _cov(patches)
       Λ, V = np.linalg.eigh(Σ, UPLO='U')
       return np.flip(Λ, 0), np.flip(V.T.reshape(c*h*w, c, h, w), 0)
 
@@ -138,10 +149,10 @@ def train_cifar():
 
   # ========== Loss ==========
   def cross_entropy(x:Tensor, y:Tensor, reduction:str='mean', label_smoothing:float=0.0) -> Tensor:
-    divisor = y.shape[1]
-    assert isinstance(divisor, int), "only supported int divisor"
-    y = (1 - label_smoothing)*y + label_smoothing / divisor
-    ret = -x.log_softmax(axis=1).mul(y).sum(axis=1)
+    # smoothing towards the uniform target is the mean of the log probs, so the smoothed y is never materialized
+    lsm = x.float().log_softmax(axis=1)
+    ret = -lsm.mul(y.float()).sum(axis=1)
+    if label_smoothing: ret = (1 - label_smoothing)*ret - label_smoothing*lsm.mean(axis=1)
     if reduction=='none': return ret
     if reduction=='sum': return ret.sum()
     if reduction=='mean': return ret.mean()
@@ -149,38 +160,54 @@ def train_cifar():
 
   # ========== Preprocessing ==========
   # NOTE: this only works for RGB in format of NxCxHxW and pads the HxW
+  # it's called once on the whole train set before training, so a single numpy pass beats the flip/cat chain
   def pad_reflect(X, size=2) -> Tensor:
-    X = X[...,:,1:size+1].flip(-1).cat(X, X[...,:,-(size+1):-1].flip(-1), dim=-1)
-    X = X[...,1:size+1,:].flip(-2).cat(X, X[...,-(size+1):-1,:].flip(-2), dim=-2)
-    return X
+    return Tensor(np.pad(X.numpy(), ((0,0),(0,0),(size,size),(size,size)), mode='reflect'), device=X.device)
+
+  # arange is a cumsum kernel, the index grids only depend on the image size so they are built once
+  @functools.lru_cache(None)
+  def index_grids(H, W) -> Tuple[Tensor, Tensor]:
+    return Tensor.arange(W).reshape((1,1,1,W)).realize(), Tensor.arange(H).reshape((1,1,H,1)).realize()
 
   # return a binary mask in the format of BS x C x H x W where H x W contains a random square mask
   def make_square_mask(shape, mask_size) -> Tensor:
     BS, _, H, W = shape
     low_x = Tensor.randint(BS, low=0, high=W-mask_size).reshape(BS,1,1,1)
     low_y = Tensor.randint(BS, low=0, high=H-mask_size).reshape(BS,1,1,1)
-    idx_x = Tensor.arange(W).reshape((1,1,1,W))
-    idx_y = Tensor.arange(H).reshape((1,1,H,1))
+    idx_x, idx_y = index_grids(H, W)
     return (idx_x >= low_x) * (idx_x < (low_x + mask_size)) * (idx_y >= low_y) * (idx_y < (low_y + mask_size))
 
+  # select the crop on device, one masked view per possible offset, instead of boolean indexing on the host
   def random_crop(X:Tensor, crop_size=32):
-    mask = make_square_mask(X.shape, crop_size)
-    mask = mask.expand((-1,3,-1,-1))
-    X_cropped = Tensor(X.numpy()[mask.numpy()])
-    return X_cropped.reshape((-1, 3, crop_size, crop_size))
+    BS, _, H, W = X.shape
+    low_x = Tensor.randint(BS, low=0, high=W-crop_size).reshape(BS,1,1,1)
+    low_y = Tensor.randint(BS, low=0, high=H-crop_size).reshape(BS,1,1,1)
+    X = sum((low_y == y).where(X[..., y:y+crop_size, :], 0) for y in range(H-crop_size))
+    return sum((low_x == x).where(X[..., x:x+crop_size], 0) for x in range(W-crop_size))
 
   def cutmix(X:Tensor, Y:Tensor, mask_size=3):
     # fill the square with randomly selected images from the same batch
+    # NOTE: a random cyclic shift pairs every image with another one using only movement ops, Tensor indexing by a permutation is O(N^2)
     mask = make_square_mask(X.shape, mask_size)
-    order = list(range(0, X.shape[0]))
-    random.shuffle(order)
-    X_patch = Tensor(X.numpy()[order], device=X.device)
-    Y_patch = Tensor(Y.numpy()[order], device=Y.device)
+    shift = random.randint(1, X.shape[0]-1)
+    X_patch = X[shift:].cat(X[:shift])
+    Y_patch = Y[shift:].cat(Y[:shift])
     X_cutmix = mask.where(X_patch, X)
     mix_portion = float(mask_size**2)/(X.shape[-2]*X.shape[-1])
     Y_cutmix = mix_portion * Y_patch + (1. - mix_portion) * Y
     return X_cutmix, Y_cutmix
 
+  # runs on a background thread so the host gathers the next batches while the current step runs, only numpy is used here
+  def gather_batches(X:np.ndarray, Y:np.ndarray, order:np.ndarray, BS:int, q:queue.Queue):
+    try:
+      for i in range(0, X.shape[0], BS):
+        # pad the last batch  # TODO: not correct for test
+        batch_end = min(i+BS, Y.shape[0])
+        q.put((X[order[batch_end-BS:batch_end]], Y[order[batch_end-BS:batch_end]]))
+    except Exception as e:
+      # hand the error to fetch_batches, otherwise the main thread waits on the queue forever
+      q.put(e)
+
   # the operations that remain inside batch fetcher is the ones that involves random operations
   def fetch_batches(X_in:Tensor, Y_in:Tensor, BS:int, is_train:bool):
     step, epoch = 0, 0
@@ -194,46 +221,56 @@ def train_cifar():
         if getenv("RANDOM_FLIP", 1):
           X = (Tensor.rand(X.shape[0],1,1,1) < 0.5).where(X.flip(-1), X) # flip LR
         if getenv("CUTMIX", 1):
-          if step >= hyp['net']['cutmix_steps']:
+          # step counts micro-batches, cutmix_steps counts optimizer steps
+          if step >= hyp['net']['cutmix_steps']*ACCUM:
             X, Y = cutmix(X, Y, mask_size=hyp['net']['cutmix_size'])
-        order = list(range(0, X.shape[0]))
-        random.shuffle(order)
-        X, Y = X.numpy()[order], Y.numpy()[order]
-      else:
-        X, Y = X.numpy(), Y.numpy()
+      X, Y = X.numpy(), Y.numpy()
+      # shuffle the indices instead of the data, every batch gathers only its own rows
+      order = np.random.default_rng(random.getrandbits(32)).permutation(X.shape[0]) if is_train else np.arange(X.shape[0])
       et = time.monotonic()
       print(f"shuffling {'training' if is_train else 'test'} dataset in {(et-st)*1e3:.2f} ms ({epoch=})")
-      for i in range(0, X.shape[0], BS):
-        # pad the last batch  # TODO: not correct for test
-        batch_end = min(i+BS, Y.shape[0])
-        x = Tensor(X[batch_end-BS:batch_end], device=X_in.device)
-        y = Tensor(Y[batch_end-BS:batch_end], device=Y_in.device)
+      q: queue.Queue = queue.Queue(maxsize=2)
+      threading.Thread(target=gather_batches, args=(X, Y, order, BS, q), daemon=True).start()
+      for _ in range(0, X.shape[0], BS):
+        if isinstance(batch := q.get(), Exception): raise batch
+        x, y = batch
         step += 1
-        yield x, y
+        yield Tensor(x, device=X_in.device), Tensor(y, device=Y_in.device)
       epoch += 1
       if not is_train: break
 
   transform = [
-    lambda x: x / 255.0,
-    lambda x: (x.reshape((-1,3,32,32)) - Tensor(cifar_mean).reshape((1,3,1,1)))/Tensor(cifar_std).reshape((1,3,1,1))
+    lambda x: (x.reshape((-1,3,32,32)) - CIFAR_MEAN) / CIFAR_STD
   ]
 
   class modelEMA():
     def __init__(self, w, net):
       # self.model_ema = copy.deepcopy(net) # won't work for opencl due to unpickeable pyopencl._cl.Buffer
       self.net_ema = SpeedyResNet(w)
-      for net_ema_param, net_param in zip(get_state_dict(self.net_ema).values(), get_state_dict(net).values()):
+      ema_state, net_state = get_state_dict(self.net_ema), get_state_dict(net)
+      for net_ema_param, net_param in zip(ema_state.values(), net_state.values()):
         net_ema_param.requires_grad = False
         net_ema_param.assign(net_param.numpy())
+      # batchnorm currently is not being tracked, and tensors shared with net (the whitening) are left alone since net owns them
+      self.param_names = [k for k in ema_state if not ("num_batches_tracked" in k) and not ("running" in k) and ema_state[k] is not net_state[k]]
+      # the tracked params become views into one flat buffer, so update is a single kernel instead of one per param
+      self.flat = Tensor.cat(*[ema_state[k].flatten() for k in self.param_names]).contiguous().realize()
+      # NOTE: this pokes the views into the params' lazydata, it only works as long as update's assign writes flat in place
+      offset = 0
+      for k in self.param_names:
+        ema_state[k].lazydata = self.flat[offset:offset+ema_state[k].numel()].reshape(ema_state[k].shape).lazydata
+        offset += ema_state[k].numel()
 
     @TinyJit
     def update(self, net, decay):
       # TODO with Tensor.no_grad()
       Tensor.no_grad = True
-      for net_ema_param, (param_name, net_param) in zip(get_state_dict(self.net_ema).values(), get_state_dict(net).items()):
-        # batchnorm currently is not being tracked
-        if not ("num_batches_tracked" in param_name) and not ("running" in param_name):
-          net_ema_param.assign(net_ema_param.detach()*decay + net_param.detach()*(1.-decay)).realize()
+      net_state = get_state_dict(net)
+      net_flat = Tensor.cat(*[net_state[k].detach().flatten() for k in self.param_names])
+      flat_buf = self.flat.lazydata.base.realized
+      self.flat.assign(self.flat.detach()*decay + net_flat*(1.-decay)).realize()
+      # only checked on the calls the jit captures, not on replays
+      assert self.flat.lazydata.base.realized is flat_buf, "EMA update did not write into the flat buffer"
       Tensor.no_grad = False
 
   set_seed(getenv('SEED', hyp['seed']))
@@ -285,22 +322,60 @@ def train_cifar():
   lr_sched_bias     = OneCycleLR(opt_bias,     max_lr=hyp['opt']['bias_lr'],     pct_start=pct_start, div_factor=initial_div_factor, final_div_factor=1./(initial_div_factor*final_lr_ratio), total_steps=STEPS)
   lr_sched_non_bias = OneCycleLR(opt_non_bias, max_lr=hyp['opt']['non_bias_lr'], pct_start=pct_start, div_factor=initial_div_factor, final_div_factor=1./(initial_div_factor*final_lr_ratio), total_steps=STEPS)
 
-  def train_step(model, optimizer, lr_scheduler, X, Y):
+  # with ACCUM > 1 the gradients of the first ACCUM-1 micro-batches are summed here and the optimizer only steps on the last one
+  # they are kept in float32 so HALF=1 doesn't sum the micro-batches in float16
+  grads_accum = [Tensor.zeros(*x.shape, dtype=dtypes.float32, device=x.device, requires_grad=False).contiguous().realize()
+                 for x in params_bias+params_non_bias] if ACCUM > 1 else []
+
+  def compute_loss(model, X, Y):
     out = model(X)
-    loss_batchsize_scaler = 512/BS
-    loss = cross_entropy(out, Y, reduction='none', label_smoothing=hyp['opt']['label_smoothing']).mul(hyp['opt']['loss_scale_scaler']*loss_batchsize_scaler).sum().div(hyp['opt']['loss_scale_scaler'])
+    loss_batchsize_scaler = 512/(BS*ACCUM)
+    return cross_entropy(out, Y, reduction='none', label_smoothing=hyp['opt']['label_smoothing']).mul(loss_batchsize_scaler).sum()
+
+  # the dynamic loss scale only helps float16 grads. in float32 the step stays a single jit that never syncs on the grads
+  scale_loss = dtypes.default_float == dtypes.float16
+
+  def accum_step(model, optimizer, loss_scale, X, Y):
+    loss = compute_loss(model, X, Y)
+    optimizer[0].zero_grad()
+    optimizer[1].zero_grad()
+    (loss.mul(loss_scale[0]) if scale_loss else loss).backward()
+    for x, g in zip(params_bias+params_non_bias, grads_accum): g.assign(g + x.grad.float())
+    Tensor.corealize([loss] + grads_accum)
+    return loss
+
+  accum_step_jitted = TinyJit(accum_step)
+
+  def optimizer_step(optimizer, lr_scheduler):
+    optimizer[0].step()
+    optimizer[1].step()
+    lr_scheduler[0].step()
+    lr_scheduler[1].step()
+
+  # with scale_loss the optimizer step is a separate jit so the host can skip it when the scaled gradients overflowed
+  optimizer_step_jitted = TinyJit(optimizer_step)
+
+  def train_step(model, optimizer, lr_scheduler, loss_scale, X, Y):
+    loss = compute_loss(model, X, Y)
+    grads_sq_sum = None
 
     if not getenv("DISABLE_BACKWARD"):
       # index 0 for bias and 1 for non-bias
       optimizer[0].zero_grad()
       optimizer[1].zero_grad()
-      loss.backward()
-
-      optimizer[0].step()
-      optimizer[1].step()
-      lr_scheduler[0].step()
-      lr_scheduler[1].step()
-    return loss.realize()
+      (loss.mul(loss_scale[0]) if scale_loss else loss).backward()
+      for x, g in zip(params_bias+params_non_bias, grads_accum): x.grad = (x.grad.float() + g).cast(x.grad.dtype)
+
+      if scale_loss:
+        # unscale before the optimizer sees the grads, any inf or nan in them makes the sum of squares non-finite
+        for x in params_bias+params_non_bias: x.grad = x.grad.float().div(loss_scale).cast(x.grad.dtype)
+        grads_sq_sum = sum(x.grad.float().square().sum() for x in params_bias+params_non_bias)
+        Tensor.corealize([loss, grads_sq_sum] + [x.grad for x in params_bias+params_non_bias])
+      else:
+        optimizer_step(optimizer, lr_scheduler)
+      for g in grads_accum: g.assign(g.zeros_like().contiguous())
+      Tensor.corealize(grads_accum)
+    return loss.realize(), grads_sq_sum
 
   train_step_jitted = TinyJit(train_step)
 
@@ -324,7 +399,16 @@ def train_cifar():
   model_ema: Optional[modelEMA] = None
   projected_ema_decay_val = hyp['ema']['decay_base'] ** hyp['ema']['every_n_steps']
   i = 0
+  loss_scale, loss_scale_good_steps = hyp['opt']['loss_scale'], 0
+  make_loss_scale = lambda scale: Tensor([scale], dtype=dtypes.float32, device=GPUS if len(GPUS) > 1 else GPUS[0], requires_grad=False)
+  loss_scale_t = make_loss_scale(loss_scale)
   batcher = fetch_batches(X_train, Y_train, BS=BS, is_train=True)
+  def next_batch():
+    X, Y = next(batcher)
+    if len(GPUS) > 1:
+      X.shard_(GPUS, axis=0)
+      Y.shard_(GPUS, axis=0)
+    return X, Y
   with Tensor.train():
     st = time.monotonic()
     while i <= STEPS:
@@ -359,15 +443,28 @@ def train_cifar():
       if STEPS == 0 or i == STEPS: break
 
       GlobalCounters.reset()
-      X, Y = next(batcher)
-      if len(GPUS) > 1:
-        X.shard_(GPUS, axis=0)
-        Y.shard_(GPUS, axis=0)
-
       with Context(BEAM=getenv("LATEBEAM", BEAM.value), WINO=getenv("LATEWINO", WINO.value)):
-        loss = train_step_jitted(model, [opt_bias, opt_non_bias], [lr_sched_bias, lr_sched_non_bias], X, Y)
+        if not getenv("DISABLE_BACKWARD"):
+          for _ in range(ACCUM-1): accum_step_jitted(model, [opt_bias, opt_non_bias], loss_scale_t, *next_batch())
+        X, Y = next_batch()
+        loss, grads_sq_sum = train_step_jitted(model, [opt_bias, opt_non_bias], [lr_sched_bias, lr_sched_non_bias], loss_scale_t, X, Y)
+        if grads_sq_sum is not None:
+          if math.isfinite(grads_sq_sum.item()):
+            optimizer_step_jitted([opt_bias, opt_non_bias], [lr_sched_bias, lr_sched_non_bias])
+            loss_scale_good_steps += 1
+            if loss_scale_good_steps % hyp['opt']['loss_scale_growth'] == 0:
+              loss_scale *= 2
+              loss_scale_t = make_loss_scale(loss_scale)
+          else:
+            # the LR schedule still advances, so a run with skipped steps still ends at the annealed LR
+            lr_sched_bias.step()
+            lr_sched_non_bias.step()
+            loss_scale, loss_scale_good_steps = loss_scale / 2, 0
+            loss_scale_t = make_loss_scale(loss_scale)
+            print(f"gradient overflow, skipping step {i} and lowering the loss scale to {loss_scale}")
         et = time.monotonic()
-        loss_cpu = loss.numpy()
+        # loss is the last micro-batch's share of the step, scale it back to a full step's loss
+        loss_cpu = loss.numpy() * ACCUM
       # EMA for network weights
       if getenv("EMA") and i > hyp['ema']['steps'] and (i+1) % hyp['ema']['every_n_steps'] == 0:
         if model_ema is None:
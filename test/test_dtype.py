@@ -482,5 +482,13 @@ class TestAutoCastType(unittest.TestCase):
     assert Tensor([1, 2], dtype=dt).maximum(3).dtype == (dt if dtypes.is_float(dt) or dtypes.is_int(dt) else dtypes.default_int)
     assert Tensor([1, 2], dtype=dt).maximum(True).dtype == dt
 
+  @unittest.skipUnless(is_dtype_supported(dtypes.half), "need half")
+  def test_backward_float_loss_half_params(self):
+    dtypes.default_float = dtypes.float16
+    t = Tensor([1.0, 2.0, 3.0], requires_grad=True)
+    t.float().square().sum().backward()
+    assert t.grad.dtype == dtypes.float16
+    np.testing.assert_allclose(t.grad.numpy(), [2.0, 4.0, 6.0])
+
 if __name__ == '__main__':
   unittest.main()